@@ -1,18 +1,26 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
+from gspread.utils import fill_gaps, rowcol_to_a1
 from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
 import datetime
 import json
-import base64
 import uuid
 import math
+import re
 import time
+from collections import Counter
+from functools import lru_cache
 
 # --- NEW: Import FPDF and Enums for PDF generation ---
 from fpdf import FPDF
 from fpdf.enums import XPos, YPos
 
+# pandas 2.x 開啟 Copy-on-Write，切片/篩選結果不必防禦性複製；pandas 3 起已是預設 (選項已棄用)
+if int(pd.__version__.split('.')[0]) < 3: pd.set_option("mode.copy_on_write", True)
+
 # --- 0. 班級資料庫與設定 ---
 ALL_SUFFIXES = {
     "普通科": ["機甲", "機乙", "電甲", "電乙", "建築", "室設", "製圖"],
@@ -32,30 +40,78 @@ SPREADSHEET_NAME = "教科書填報"
 SHEET_HISTORY = "DB_History"
 SHEET_CURRICULUM = "DB_Curriculum"
 SHEET_SUBMISSION = "Submission_Records"
+SUBMISSION_HEADERS = ["uuid", "填報時間", "學年度", "科別", "學期", "年級", "課程名稱", "教科書(1)", "冊次(1)", "出版社(1)", "字號(1)", "教科書(2)", "冊次(2)", "出版社(2)", "字號(2)", "適用班級", "備註1", "備註2"]
+
+# 舊版 Submission 表頭 -> 寫入時取值的標準欄名
+SUBMISSION_WRITE_ALIASES = {"字號": "字號(1)", "審定字號": "字號(1)", "備註": "備註1"}
+
+DEPT_OPTIONS = ["建築科", "機械科", "電機科", "製圖科", "室設科", "國文科", "英文科", "數學科", "自然科", "社會科", "資訊科技", "體育科", "國防科", "藝術科", "健護科", "輔導科", "閩南語"]
+VOL_OPTS = ["全", "上", "下", "I", "II", "III", "IV", "V", "VI"]
+VOL_IDX = {v: i for i, v in enumerate(VOL_OPTS)}
+CLASS_CHECKBOXES = (('cb_reg', '普通科'), ('cb_prac', '實用技能班'), ('cb_coop', '建教班'))
+_CLASS_SPLIT = re.compile(r'[,，\s]+')
+_GRADE_PREFIX = {"1": "一", "2": "二", "3": "三"}
+# str.translate 用的對照表：一次掃描完成多個字元的刪除/替換
+_STRIP_QUOTES = str.maketrans('', '', '"\'')
+_FLATTEN_LINES = str.maketrans({'\r': None, '\n': ' '})
+# 舊版工作表欄名 -> 標準欄名
+HEADER_ALIASES = {
+    '教科書(1)': '教科書(優先1)', '教科書': '教科書(優先1)',
+    '字號(1)': '審定字號(1)', '字號': '審定字號(1)', '審定字號': '審定字號(1)',
+    '教科書(2)': '教科書(優先2)', '字號(2)': '審定字號(2)', '備註': '備註1'
+}
+
+PREVIEW_COLUMN_ORDER = ["勾選", "學期", "年級", "課程名稱", "教科書(優先1)", "出版社(1)", "適用班級", "備註1"]
+PREVIEW_DISABLED = ["科別", "學期", "年級", "課程名稱", "教科書(優先1)", "冊次(1)", "出版社(1)", "審定字號(1)", "教科書(優先2)", "冊次(2)", "出版社(2)", "審定字號(2)", "適用班級", "備註1", "備註2"]
+CURRICULUM_COLUMNS = ['科別', '年級', '學期', '課程名稱', '課程類別', '預設適用班級', '適用班級']
+FORM_KEYS = ('course', 'book1', 'pub1', 'code1', 'book2', 'pub2', 'code2', 'note1', 'note2')
+# main() 每次 rerun 補齊的 session_state 預設值 (皆為不可變值；list/dict 於 main() 內另建新物件)
+SESSION_DEFAULTS = {
+    'edit_index': None, 'current_uuid': None, 'last_selected_row': None, 'editor_key_counter': 0,
+    'use_history_checkbox': False, 'show_preview': False, 'last_dept': None, 'last_grade': None
+}
+EDITOR_COLUMN_ORDER = ["勾選", "課程類別", "課程名稱", "適用班級", "教科書(優先1)", "冊次(1)", "出版社(1)", "審定字號(1)", "備註1", "教科書(優先2)", "冊次(2)", "出版社(2)", "審定字號(2)", "備註2"]
+# get_merged_data 輸出欄序 (其餘欄位依原順序接在後面)
+OUTPUT_COLUMN_ORDER = ("勾選", "uuid", "科別", "年級", "學期", *EDITOR_COLUMN_ORDER[1:])
 
 # --- 輔助函式 ---
-def safe_note(row):
-    note_cols = [c for c in row.index if "備註" in str(c)]
+def row_uuid(val):
+    """列的 uuid；空值 (含 data_editor 新增列的 <NA>/None) 回傳空字串"""
+    return "" if val is None or pd.isna(val) else str(val).strip()
+
+def clean_note_columns(df):
+    """備註欄 (依欄位順序) 整欄整理成 (備註1, 備註2) 兩個 Series；同列兩者相同時備註2 留空"""
     notes = []
-    for col in note_cols:
-        val = row[col]
-        if isinstance(val, pd.Series):
-            val = val.iloc[0] if not val.empty else ""
-        if val is None or str(val).lower() == "nan":
-            val = ""
-        val = str(val).replace("備註1", "").replace("備註2", "")
-        if "dtype" in val: val = val.split("Name:")[0]
-        val = val.replace("\n", " ").strip()
-        notes.append(val)
-    r1 = notes[0] if len(notes) > 0 else ""
-    r2 = notes[1] if len(notes) > 1 else ""
-    if r1 and r2 and r1 == r2: r2 = ""
-    return [r1, r2]
+    for col in [c for c in df.columns if "備註" in str(c)][:2]:
+        v = df[col].where(df[col].notna(), "").astype(str)
+        v = v.mask(v.str.lower() == "nan", "").str.replace("備註1", "", regex=False).str.replace("備註2", "", regex=False)
+        v = v.mask(v.str.contains("dtype", regex=False), v.str.split("Name:").str[0])
+        notes.append(v.str.translate(_FLATTEN_LINES).str.strip())
+    while len(notes) < 2: notes.append(pd.Series("", index=df.index))
+    r1, r2 = notes
+    return r1, r2.mask((r1 != "") & (r1 == r2), "")
+
+@lru_cache(maxsize=1024)
+def _class_tokens(class_str):
+    """同一個適用班級字串只拆解一次；回傳 tuple 以免快取內容被改動"""
+    return tuple(c for c in _CLASS_SPLIT.split(class_str) if c)
+
+def split_classes(class_str):
+    if not class_str: return []
+    return list(_class_tokens(str(class_str)))
 
 def parse_classes(class_str):
     if not class_str: return set()
-    clean_str = str(class_str).replace('"', '').replace("'", "").replace('，', ',')
-    return {c.strip() for c in clean_str.split(',') if c.strip()}
+    return set(split_classes(str(class_str).translate(_STRIP_QUOTES)))
+
+def parse_class_series(series):
+    """parse_classes 的整欄版本：一次拆解整個 Series，回傳每列的班級 frozenset"""
+    tokens = (series.fillna('').astype(str)
+              .str.translate(_STRIP_QUOTES)
+              .str.split(_CLASS_SPLIT).explode())
+    grouped = tokens[tokens != ''].groupby(level=0).agg(frozenset)
+    empty = frozenset()
+    return pd.Series([grouped.get(i, empty) for i in series.index], index=series.index, dtype=object)
 
 def check_class_match(def_s, sub_s):
     d_set, s_set = parse_classes(def_s), parse_classes(sub_s)
@@ -63,41 +119,112 @@ def check_class_match(def_s, sub_s):
     if not s_set: return False
     return not d_set.isdisjoint(s_set)
 
-def get_target_classes_for_dept(dept, grade, sys_name):
-    prefix = {"1": "一", "2": "二", "3": "三"}.get(str(grade), "")
+def _build_target_classes(dept, grade, sys_name):
+    prefix = _GRADE_PREFIX.get(str(grade), "")
     suffixes = DEPT_SPECIFIC_CONFIG[dept].get(sys_name, []) if dept in DEPT_SPECIFIC_CONFIG else ALL_SUFFIXES.get(sys_name, [])
-    return [f"{prefix}{s}" for s in suffixes] if not (str(grade)=="3" and sys_name=="建教班") else []
+    return tuple(f"{prefix}{s}" for s in suffixes) if not (str(grade)=="3" and sys_name=="建教班") else ()
 
-def get_all_possible_classes(grade):
-    prefix = {"1": "一", "2": "二", "3": "三"}.get(str(grade), "")
-    if not prefix: return []
+def _build_all_possible_classes(grade):
+    prefix = _GRADE_PREFIX.get(str(grade), "")
+    if not prefix: return ()
     classes = []
     for sys_name, suffixes in ALL_SUFFIXES.items():
         if str(grade) == "3" and sys_name == "建教班": continue
         for s in suffixes: classes.append(f"{prefix}{s}")
-    return sorted(list(set(classes)))
+    return tuple(sorted(set(classes)))
+
+# 科別 × 年級 × 學制 的班級表於載入時一次算好；非專業科共用 ALL_SUFFIXES (以 None 為鍵)
+# 值為 tuple：不可變、跨 rerun 共用同一物件
+_TARGET_CLASSES = {
+    (d, g, sys_name): _build_target_classes(d, g, sys_name)
+    for d in [*DEPT_SPECIFIC_CONFIG, None] for g in _GRADE_PREFIX for sys_name in ALL_SUFFIXES
+}
+_ALL_CLASSES = {g: _build_all_possible_classes(g) for g in _GRADE_PREFIX}
+# 同一份班級表的 frozenset 版本，供成員檢查 O(1) 使用
+_ALL_CLASS_SETS = {g: frozenset(v) for g, v in _ALL_CLASSES.items()}
+
+def get_target_classes_for_dept(dept, grade, sys_name):
+    key = (dept if dept in DEPT_SPECIFIC_CONFIG else None, str(grade), sys_name)
+    if key in _TARGET_CLASSES: return _TARGET_CLASSES[key]
+    return _build_target_classes(dept, grade, sys_name)
+
+def get_all_possible_classes(grade):
+    return _ALL_CLASSES.get(str(grade), ())
+
+def get_valid_class_set(grade):
+    return _ALL_CLASS_SETS.get(str(grade), frozenset())
 
 # --- 1. 連線設定 ---
+# cache_resource 不快取例外：認證/開檔失敗時直接丟出，只有成功的 client 才會留在快取
 @st.cache_resource
 def get_connection():
     scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
     if "GCP_CREDENTIALS" in st.secrets:
-        try:
-            creds_dict = json.loads(st.secrets["GCP_CREDENTIALS"])
-            creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        except Exception: return None
+        creds_dict = json.loads(st.secrets["GCP_CREDENTIALS"])
+        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
     else:
-        try:
-            creds = Credentials.from_service_account_file('credentials.json', scopes=scope)
-        except Exception: return None
-    return gspread.authorize(creds)
+        creds = Credentials.from_service_account_file('credentials.json', scopes=scope)
+    client = gspread.authorize(creds)
+    # 同一個 client 跨 session/執行緒共用：加大連線池，並發請求時重用既有 TLS 連線
+    session = getattr(client, 'http_client', client).session
+    session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=3))
+    return client
+
+@st.cache_resource
+def _open_spreadsheet():
+    return get_connection().open(SPREADSHEET_NAME)
+
+CONNECTION_RETRY_SECONDS = 30
+
+@st.cache_resource(show_spinner=False)
+def _connection_failure():
+    """最近一次連線失敗紀錄 {'at': 時間, 'error': 例外}；冷卻時間內不再重新解析憑證與認證"""
+    return {}
+
+def get_spreadsheet():
+    """取得試算表；連線失敗時回傳 None，失敗後 30 秒內的 rerun 直接略過重試"""
+    failure = _connection_failure()
+    # 以失敗當下的時間計算冷卻，不依快取建立時間
+    if failure and time.time() - failure['at'] < CONNECTION_RETRY_SECONDS: return None
+    try: sh = _open_spreadsheet()
+    except Exception as e:
+        failure.update(at=time.time(), error=e)
+        return None
+    failure.clear()
+    return sh
+
+def get_ws(name):
+    sh = get_spreadsheet()
+    if not sh: return None
+    return _open_ws(name)
+
+@st.cache_resource(ttl=600, show_spinner=False)
+def _ws_by_title():
+    """一次 metadata 請求列出所有工作表 {標題: handle}，取代逐張以例外探測"""
+    return {ws.title: ws for ws in _open_spreadsheet().worksheets()}
+
+@st.cache_resource(ttl=600, show_spinner=False)
+def _open_ws(name):
+    """取得工作表 handle (跨 rerun 共用)；Submission 不存在時於此建立一次"""
+    ws = _ws_by_title().get(name)
+    if ws: return ws
+    # 清單可能過期 (工作表在外部改名或重建)，重新列一次再判斷
+    _ws_by_title.clear()
+    ws = _ws_by_title().get(name)
+    if ws: return ws
+    if name != SHEET_SUBMISSION: raise gspread.exceptions.WorksheetNotFound(name)
+    ws_sub = _open_spreadsheet().add_worksheet(title=SHEET_SUBMISSION, rows=1000, cols=20)
+    ws_sub.append_row(SUBMISSION_HEADERS)
+    _ws_by_title.clear()
+    return ws_sub
 
 # --- 安全讀取與快取機制 ---
-def safe_get_all_values(ws):
+def safe_api_call(func, *args, **kwargs):
+    """呼叫 Google API，遇到 429/Quota 時以指數退避重試；重試用盡回傳 None"""
     max_retries = 5
     for i in range(max_retries):
         try:
-            return ws.get_all_values()
+            return func(*args, **kwargs)
         except Exception as e:
             if "429" in str(e) or "Quota" in str(e):
                 wait_time = (2 ** i) + 1
@@ -105,26 +232,40 @@ def safe_get_all_values(ws):
             else:
                 raise e
     st.error("系統忙碌 (Google API 流量超載)，請稍後再試。")
-    return []
+    return None
+
+def safe_get_all_values(ws):
+    return safe_api_call(ws.get_all_values) or []
 
-@st.cache_data(ttl=3600)
-def get_cached_curriculum():
-    client = get_connection()
-    if not client: return []
+def fetch_reference_values():
+    """以單一 batchGet 同時讀取 Curriculum 與 History，回傳 (curr_values, hist_values)"""
     try:
-        sh = client.open(SPREADSHEET_NAME)
-        ws_curr = sh.worksheet(SHEET_CURRICULUM)
-        return safe_get_all_values(ws_curr)
-    except Exception: return []
+        sh = get_spreadsheet()
+        if not sh: return [], []
+        resp = safe_api_call(sh.values_batch_get, [f"'{SHEET_CURRICULUM}'", f"'{SHEET_HISTORY}'"])
+        if not resp: return [], []
+        # values API 會省略列尾空白儲存格，補齊成與 get_all_values 相同的矩形
+        curr_values, hist_values = [fill_gaps(vr['values']) if vr.get('values') else [] for vr in resp.get('valueRanges', [{}, {}])]
+        return curr_values, hist_values
+    except Exception: return [], []
+
+# cache_resource 直接回傳同一份 DataFrame (免 pickle 複製)，呼叫端只可讀不可修改
+# Submission 會被本系統寫入，存檔/刪除/同步後須呼叫 get_cached_submission.clear()
+# 刻意不併入 fetch_reference_values 的 batchGet：否則每次存檔都會連帶重抓兩張參考表
+@st.cache_resource(ttl=300, show_spinner=False)
+def get_cached_submission():
+    """Submission 正規化 (欄名去重) 後的 DataFrame；工作表沒有任何資料時回傳 None"""
+    ws_sub = get_ws(SHEET_SUBMISSION)
+    if not ws_sub: return None
+    values = safe_get_all_values(ws_sub)
+    return categorize_keys(normalize_df(values[0], values[1:]), ['科別', '學期', '年級']) if values else None
 
 # --- 讀取雲端密碼 ---
 @st.cache_data(ttl=600)
 def get_cloud_password():
-    client = get_connection()
-    if not client: return None, None
     try:
-        sh = client.open(SPREADSHEET_NAME)
-        ws = sh.worksheet("Dashboard")
+        ws = get_ws("Dashboard")
+        if not ws: return None, None
         vals = safe_get_all_values(ws)
         if len(vals) > 1:
             val_year = vals[1][0] # A2
@@ -135,34 +276,22 @@ def get_cloud_password():
 
 # --- 取得可用的歷史學年度 ---
 def get_history_years(current_year):
-    client = get_connection()
-    if not client: return []
     try:
-        sh = client.open(SPREADSHEET_NAME)
-        ws_hist = sh.worksheet(SHEET_HISTORY)
-        data = safe_get_all_values(ws_hist)
-        if not data or len(data) < 2: return []
-        headers = [str(h).strip() for h in data[0]]
-        
-        if "學年度" not in headers: return []
-        year_idx = headers.index("學年度")
+        _, df_hist = get_reference_frames()
+        if df_hist.empty or "學年度" not in df_hist.columns: return []
         
-        unique_years = set()
-        for row in data[1:]:
-            if len(row) > year_idx:
-                y = str(row[year_idx]).strip()
-                if y and y != str(current_year):
-                    unique_years.add(y)
-                elif not y: 
-                    unique_years.add("未填寫")
+        years = df_hist['學年度'].astype(str)
+        unique_years = set(years[(years != '') & (years != str(current_year))])
+        if (years == '').any(): unique_years.add("未填寫")
                     
-        return sorted(list(unique_years), reverse=True)
+        return sorted(unique_years, reverse=True)
     except Exception: return []
 
 # --- 登出與檢查 ---
 def logout():
     st.session_state["logged_in"] = False
     st.session_state["current_school_year"] = None
+    for k in ('data', 'preview_df', 'preview_memo', 'loaded'): st.session_state.pop(k, None)
     st.query_params.clear()
     st.rerun()
     
@@ -205,24 +334,34 @@ def check_login():
 # --- 2. 核心資料處理函式 (Data Fetching Helpers) ---
 
 def fetch_raw_dataframes():
-    """讀取 Submission, History, Curriculum 的原始資料"""
-    client = get_connection()
-    if not client: return None, None, None, None
-
+    """讀取 Submission, History, Curriculum 正規化後的 DataFrame (皆已快取，勿原地修改)"""
     try:
-        sh = client.open(SPREADSHEET_NAME)
-        ws_sub = sh.worksheet(SHEET_SUBMISSION)
-        sub_values = safe_get_all_values(ws_sub)
-        
-        ws_hist = sh.worksheet(SHEET_HISTORY)
-        hist_values = safe_get_all_values(ws_hist)
-        
-        curr_values = get_cached_curriculum()
+        df_sub = get_cached_submission()
+        df_curr, df_hist = get_reference_frames()
         
-        return sub_values, hist_values, curr_values, sh
+        return df_sub, df_hist, df_curr
     except Exception as e:
         st.error(f"讀取失敗: {e}")
-        return None, None, None, None
+        return None, None, None
+
+@lru_cache(maxsize=8)
+def normalize_headers(headers):
+    """表頭轉為標準欄名並為重複者編號；同一組表頭 (tuple) 只算一次"""
+    # 統一將所有形式的 uuid 轉為小寫 'uuid'，其餘別名查表轉為標準欄名
+    names = [c.strip() for c in headers]
+    names = ['uuid' if c.lower() == 'uuid' else HEADER_ALIASES.get(c, c) for c in names]
+    
+    # 檢查重複：第 n 次出現者依欄位種類改名
+    seen = Counter()
+    new_headers = []
+    for name in names:
+        seen[name] += 1
+        n = seen[name]
+        if n == 1: new_headers.append(name)
+        elif name == 'uuid': new_headers.append(f"uuid_{n}")
+        elif name.startswith('備註'): new_headers.append(f"備註{n}")
+        else: new_headers.append(f"{name}({n})")
+    return tuple(new_headers)
 
 def normalize_df(headers, rows):
     """
@@ -231,68 +370,59 @@ def normalize_df(headers, rows):
     """
     if not headers: return pd.DataFrame()
     
-    mapping = {
-        '教科書(1)': '教科書(優先1)', '教科書': '教科書(優先1)',
-        '字號(1)': '審定字號(1)', '字號': '審定字號(1)', '審定字號': '審定字號(1)',
-        '教科書(2)': '教科書(優先2)', '字號(2)': '審定字號(2)', '備註': '備註1'
-    }
-    
-    new_headers = []
-    seen = {}
-    
-    for col in headers:
-        c = str(col).strip()
-        
-        # 統一將所有形式的 uuid 轉為小寫 'uuid'
-        if c.lower() == 'uuid':
-            final_name = 'uuid'
-        else:
-            final_name = mapping.get(c, c)
-            
-        # 檢查重複
-        if final_name in seen:
-            seen[final_name] += 1
-            if final_name == 'uuid':
-                unique_name = f"uuid_{seen[final_name]}" 
-            elif final_name.startswith('備註'): 
-                unique_name = f"備註{seen[final_name]}"
-            else: 
-                unique_name = f"{final_name}({seen[final_name]})"
-            new_headers.append(unique_name)
-        else:
-            seen[final_name] = 1
-            if final_name == '備註': 
-                new_headers.append('備註1')
-            else: 
-                new_headers.append(final_name)
-            
-    df = pd.DataFrame(rows, columns=new_headers)
+    new_headers = list(normalize_headers(tuple(str(col) for col in headers)))
+    df = pd.DataFrame.from_records(rows, columns=new_headers, coerce_float=False)
     
     # 確保資料中只有一個有效的 uuid 欄位
     cols_to_keep = [c for c in df.columns if not c.startswith('uuid_')]
     df = df[cols_to_keep]
     
     # 確保關鍵欄位為字串且去空白
+    # Sheets 回傳的儲存格本來就是字串，只需去空白，不再整欄 astype(str) 複製一次
     for col in ['年級', '學期', '科別', 'uuid', '學年度', '課程名稱', '適用班級']:
         if col in df.columns:
-            df[col] = df[col].astype(str).str.strip()
+            df[col] = df[col].str.strip()
             
     return df
 
+def categorize_keys(df, cols):
+    """篩選用的鍵欄原地轉為 category，之後的 == 比對只比整數代碼"""
+    for col in cols:
+        if col in df.columns: df[col] = df[col].astype('category')
+    return df
+
+@st.cache_resource(ttl=600)
+def get_reference_frames():
+    """
+    Curriculum / History 正規化後的 DataFrame，回傳 (df_curr, df_hist)
+    篩選用的鍵欄轉為 category，比對時只比整數代碼；回傳共用物件，呼叫端不可原地修改
+    讀取失敗時拋出 RuntimeError (例外不會被快取，下次呼叫會重抓，不把空表留 600 秒)
+    """
+    curr_vals, hist_vals = fetch_reference_values()
+    if not curr_vals and not hist_vals: raise RuntimeError("參考資料讀取失敗")
+    df_curr = normalize_df(curr_vals[0], curr_vals[1:]) if curr_vals else pd.DataFrame()
+    # 課綱只會用到這幾欄，其餘欄位 (學分、時數等) 不留在快取中
+    df_curr = df_curr.reindex(columns=[c for c in CURRICULUM_COLUMNS if c in df_curr.columns])
+    df_hist = normalize_df(hist_vals[0], hist_vals[1:]) if hist_vals else pd.DataFrame()
+    for df in (df_curr, df_hist): categorize_keys(df, ['科別', '學期', '年級', '學年度', '課程類別'])
+    return df_curr, df_hist
+
 # --- 3. 統一資料合併邏輯 (The Engine) ---
 def get_merged_data(dept, target_semester=None, target_grade=None, use_history=False, pad_curriculum=False):
-    sub_vals, hist_vals, curr_vals, _ = fetch_raw_dataframes()
-    if not sub_vals: return pd.DataFrame()
+    df_sub, df_hist, df_curr = fetch_raw_dataframes()
+    if df_sub is None: return pd.DataFrame()
+    # 篩選值只轉一次字串；各表鍵欄在 normalize_df 已是字串
+    if target_semester: target_semester = str(target_semester)
+    if target_grade: target_grade = str(target_grade)
 
-    df_sub = normalize_df(sub_vals[0], sub_vals[1:])
-    df_hist = normalize_df(hist_vals[0], hist_vals[1:]) if hist_vals else pd.DataFrame()
-    df_curr = normalize_df(curr_vals[0], curr_vals[1:]) if curr_vals else pd.DataFrame()
+    # 本科課綱只篩一次；多數一般科目沒有課綱資料，此時直接略過下方補列與類別對映
+    curr_dept = df_curr[df_curr['科別'] == dept] if '科別' in df_curr.columns else pd.DataFrame()
 
     # --- 1. 處理 Submission ---
     mask_sub = (df_sub['科別'] == dept)
-    if target_semester: mask_sub &= (df_sub['學期'] == str(target_semester))
-    if target_grade: mask_sub &= (df_sub['年級'] == str(target_grade))
-    final_df = df_sub[mask_sub].copy()
+    if target_semester: mask_sub &= (df_sub['學期'] == target_semester)
+    if target_grade: mask_sub &= (df_sub['年級'] == target_grade)
+    final_df = df_sub[mask_sub]
     
     if '勾選' not in final_df.columns: final_df['勾選'] = False
     
@@ -314,82 +444,82 @@ def get_merged_data(dept, target_semester=None, target_grade=None, use_history=F
                 if target_year_str == "未填寫": target_year_str = ""
                 
                 mask_hist = (df_hist['科別'] == dept) & (df_hist['學年度'] == target_year_str)
-                if target_semester: mask_hist &= (df_hist['學期'] == str(target_semester))
-                if target_grade: mask_hist &= (df_hist['年級'] == str(target_grade))
+                if target_semester: mask_hist &= (df_hist['學期'] == target_semester)
+                if target_grade: mask_hist &= (df_hist['年級'] == target_grade)
                 
-                target_hist = df_hist[mask_hist].copy()
-                temp_hist_uuids = set()
-
-                for _, row in target_hist.iterrows():
-                    h_uuid = row.get('uuid', '')
-                    if not h_uuid: h_uuid = str(uuid.uuid4())
-                    
-                    if h_uuid in existing_uuids: continue
-                    if h_uuid in temp_hist_uuids: h_uuid = str(uuid.uuid4())
-                    
-                    row_data = row.to_dict()
-                    row_data['uuid'] = h_uuid
-                    row_data['勾選'] = False
-                    
-                    for k, alt in {'教科書(優先1)': '教科書(1)', '審定字號(1)': '字號(1)', '審定字號(2)': '字號(2)'}.items():
-                        if alt in row_data and k not in row_data: row_data[k] = row_data[alt]
-                    
-                    final_df = pd.concat([final_df, pd.DataFrame([row_data])], ignore_index=True)
-                    temp_hist_uuids.add(h_uuid)
-                    existing_courses.add(row.get('課程名稱', ''))
+                target_hist = df_hist[mask_hist]
+                
+                # uuid 空白者補新值、已在 Submission 者略過、History 內重複者換新值 (整欄處理，一次合併)
+                h_uuids = target_hist['uuid'] if 'uuid' in target_hist.columns else pd.Series('', index=target_hist.index)
+                blank = h_uuids == ''
+                h_uuids.loc[blank] = [str(uuid.uuid4()) for _ in range(blank.sum())]
+                keep = ~h_uuids.isin(existing_uuids)
+                target_hist, h_uuids = target_hist[keep], h_uuids[keep]
+                dup = h_uuids.duplicated()
+                h_uuids.loc[dup] = [str(uuid.uuid4()) for _ in range(dup.sum())]
+                
+                target_hist['uuid'] = h_uuids
+                target_hist['勾選'] = False
+                for k, alt in {'教科書(優先1)': '教科書(1)', '審定字號(1)': '字號(1)', '審定字號(2)': '字號(2)'}.items():
+                    if alt in target_hist.columns and k not in target_hist.columns: target_hist[k] = target_hist[alt]
+                
+                if not target_hist.empty:
+                    final_df = pd.concat([final_df, target_hist], ignore_index=True)
+                    existing_courses.update(target_hist.get('課程名稱', pd.Series(dtype=object)).tolist())
 
     # --- 3. 處理 Curriculum ---
-    if pad_curriculum and not df_curr.empty:
-        mask_curr = (df_curr['科別'] == dept)
-        if target_grade: mask_curr &= (df_curr['年級'] == str(target_grade))
-        if target_semester: mask_curr &= (df_curr['學期'] == str(target_semester))
-        target_curr = df_curr[mask_curr]
-
-        for _, c_row in target_curr.iterrows():
-            c_name = c_row['課程名稱']
-            if c_name not in existing_courses:
-                new_row = {
-                    "勾選": False, "uuid": str(uuid.uuid4()), "科別": dept,
-                    "年級": c_row['年級'], "學期": c_row['學期'],
-                    "課程類別": c_row['課程類別'], "課程名稱": c_name,
-                    "適用班級": c_row.get('預設適用班級') or c_row.get('適用班級', ''),
-                    "教科書(優先1)": "", "冊次(1)": "", "出版社(1)": "", "審定字號(1)": "",
-                    "教科書(優先2)": "", "冊次(2)": "", "出版社(2)": "", "審定字號(2)": "",
-                    "備註1": "", "備註2": ""
-                }
-                final_df = pd.concat([final_df, pd.DataFrame([new_row])], ignore_index=True)
+    if pad_curriculum and not curr_dept.empty:
+        target_curr = curr_dept
+        if target_grade: target_curr = target_curr[target_curr['年級'] == target_grade]
+        if target_semester: target_curr = target_curr[target_curr['學期'] == target_semester]
+        pad = target_curr[~target_curr['課程名稱'].isin(existing_courses)]
+
+        if not pad.empty:
+            pad_cls = pad['預設適用班級'] if '預設適用班級' in pad.columns else pd.Series('', index=pad.index)
+            if '適用班級' in pad.columns: pad_cls = pad_cls.where(pad_cls != '', pad['適用班級'])
+            pad_df = pd.DataFrame({
+                "勾選": False, "uuid": [str(uuid.uuid4()) for _ in range(len(pad))], "科別": dept,
+                "年級": pad['年級'].to_numpy(), "學期": pad['學期'].to_numpy(),
+                "課程類別": pad['課程類別'].to_numpy(), "課程名稱": pad['課程名稱'].to_numpy(),
+                "適用班級": pad_cls.to_numpy(),
+                "教科書(優先1)": "", "冊次(1)": "", "出版社(1)": "", "審定字號(1)": "",
+                "教科書(優先2)": "", "冊次(2)": "", "出版社(2)": "", "審定字號(2)": "",
+                "備註1": "", "備註2": ""
+            })
+            final_df = pd.concat([final_df, pad_df], ignore_index=True)
 
     # --- 4. 統一對映課程類別 (修正版：加入班級比對) ---
-    if not df_curr.empty:
-        complex_map = {}
-        target_curr_rows = df_curr[df_curr['科別'] == dept]
+    # 同一 (課程名稱, 年級, 學期) 可能有多筆課綱：取第一筆班級有交集者，皆無交集則取第一筆
+    if not curr_dept.empty and not final_df.empty:
+        keys = ['課程名稱', '年級', '學期']
         
-        for _, row in target_curr_rows.iterrows():
-            k = (row['課程名稱'], str(row['年級']), str(row['學期']))
-            cat = row['課程類別']
-            cls_str = row.get('預設適用班級') or row.get('適用班級', '')
-            cls_set = parse_classes(cls_str)
-            
-            if k not in complex_map: complex_map[k] = []
-            complex_map[k].append({'cat': cat, 'classes': cls_set})
-            
-        for idx, row in final_df.iterrows():
-            k = (row['課程名稱'], str(row['年級']), str(row['學期']))
-            row_classes = parse_classes(row['適用班級'])
-            
-            if k in complex_map:
-                candidates = complex_map[k]
-                found_cat = candidates[0]['cat']
-                for cand in candidates:
-                    if not row_classes.isdisjoint(cand['classes']):
-                        found_cat = cand['cat']
-                        break
-                final_df.at[idx, '課程類別'] = found_cat
+        # 適用班級整欄一次拆解 (預設適用班級空白時退回適用班級)
+        curr_cls_src = curr_dept['預設適用班級'] if '預設適用班級' in curr_dept.columns else pd.Series('', index=curr_dept.index)
+        if '適用班級' in curr_dept.columns: curr_cls_src = curr_cls_src.where(curr_cls_src != '', curr_dept['適用班級'])
+        cand = pd.DataFrame({k: curr_dept[k].astype(str).to_numpy() for k in keys})
+        cand['類別'] = curr_dept['課程類別'].astype(object).to_numpy()
+        cand['班級'] = parse_class_series(curr_cls_src).to_numpy()
+        cand['序'] = cand.groupby(keys, sort=False).cumcount()
+        
+        rows = pd.DataFrame({k: final_df[k].astype(str).to_numpy() for k in keys})
+        rows['列'] = np.arange(len(rows))
+        rows['班級'] = parse_class_series(final_df['適用班級']).to_numpy()
+        
+        # 每組第一筆候選 (left merge 保留列序；右表每鍵唯一故列數不變)
+        cats = rows[keys].merge(cand.loc[cand['序'] == 0, keys + ['類別']], on=keys, how='left')['類別'].to_numpy(dtype=object)
+        # 班級有交集者：兩邊攤平成單一班級後依 (鍵, 班級) 合併，每列取順序最前的候選
+        hit = rows.explode('班級').dropna(subset=['班級']).merge(
+            cand.explode('班級').dropna(subset=['班級']), on=keys + ['班級'])
+        hit = hit.sort_values('序', kind='stable').drop_duplicates('列')
+        cats[hit['列'].to_numpy()] = hit['類別'].to_numpy()
+        
+        mapped = pd.Series(cats, index=final_df.index, dtype=object)
+        if '課程類別' in final_df.columns: mapped = mapped.fillna(final_df['課程類別'])
+        final_df['課程類別'] = mapped
 
     # --- 5. 整理與排序 (強制正確順序) ---
-    required_cols = ["勾選", "課程類別", "課程名稱", "適用班級", "教科書(優先1)", "冊次(1)", "出版社(1)", "審定字號(1)", "備註1", "教科書(優先2)", "冊次(2)", "出版社(2)", "審定字號(2)", "備註2"]
-    for col in required_cols:
-        if col not in final_df.columns: final_df[col] = ""
+    missing = [c for c in EDITOR_COLUMN_ORDER if c not in final_df.columns]
+    if missing: final_df = final_df.reindex(columns=[*final_df.columns, *missing], fill_value="")
         
     if not final_df.empty:
         sort_cols = []
@@ -401,16 +531,18 @@ def get_merged_data(dept, target_semester=None, target_grade=None, use_history=F
         final_df = final_df.sort_values(by=sort_cols, ascending=ascending).reset_index(drop=True)
     
     # 強制去重欄位與排序
-    output_order = ['勾選', 'uuid', '科別', '年級', '學期'] + [c for c in required_cols if c not in ['勾選']]
-    existing_cols = list(final_df.columns)
-    for c in existing_cols:
-        if c not in output_order and c != 'uuid':
-            output_order.append(c)
+    output_order = list(OUTPUT_COLUMN_ORDER)
+    output_order += [c for c in final_df.columns if c not in OUTPUT_COLUMN_ORDER]
             
     valid_cols = [c for c in output_order if c in final_df.columns]
     final_df = final_df.loc[:, ~final_df.columns.duplicated()]
     final_df = final_df.reindex(columns=[c for c in valid_cols if c in final_df.columns])
 
+    # 改用 PyArrow 型別儲存 (字串連續存放，複製與合併較省記憶體)；先補空字串避免 <NA> 出現在表單與 PDF
+    # 來自 History/Curriculum 的 category 欄先轉回一般字串，之後編輯才能寫入新值
+    final_df = final_df.astype({c: object for c in final_df.select_dtypes('category').columns})
+    final_df = final_df.fillna("").convert_dtypes(dtype_backend="pyarrow")
+
     return final_df
 
 # --- 4. 應用層：載入資料 ---
@@ -420,59 +552,101 @@ def load_data(dept, semester, grade, history_year=None):
         dept, target_semester=semester, target_grade=grade, 
         use_history=use_hist, pad_curriculum=(not use_hist) 
     )
-    curr_vals = get_cached_curriculum()
-    if curr_vals:
-        df_curr = normalize_df(curr_vals[0], curr_vals[1:])
+    try: df_curr, _ = get_reference_frames()
+    except RuntimeError: df_curr = pd.DataFrame()
+    if '科別' in df_curr.columns:
         mask = (df_curr['科別'] == str(dept)) & (df_curr['學期'] == str(semester)) & (df_curr['年級'] == str(grade))
         opts = df_curr[mask]['課程名稱'].unique().tolist()
         st.session_state['curr_course_options'] = opts
+    # uuid -> 工作表列號 (同 uuid 取第一列)，存檔時據此只讀該列驗證
+    df_sub = get_cached_submission()
+    if df_sub is not None and 'uuid' in df_sub.columns:
+        uuids = df_sub['uuid'].tolist()
+        st.session_state['sub_row_index'] = dict(zip(reversed(uuids), range(len(uuids) + 1, 1, -1)))
     return df
 
 # --- 5. 應用層：預覽資料 ---
+# 預覽表與 PDF 用同一份結果：設定相同且來源 DataFrame 仍是同一批快取物件時直接沿用，
+# 預覽開著時每次重跑不再整科重併；存檔/同步清快取後來源換新物件，自然重算
 def load_preview_data(dept):
     use_hist = st.session_state.get('use_history_checkbox', False)
-    return get_merged_data(
+    key = (dept, use_hist, st.session_state.get('history_year_val'), st.session_state.get('current_school_year'))
+    # 參考表讀取失敗時不記憶，交給 get_merged_data 顯示錯誤並回傳空表
+    try: sources = (get_cached_submission(), *get_reference_frames())
+    except RuntimeError: sources = None
+    memo = st.session_state.get('preview_memo')
+    if sources and memo and memo[0] == key and all(a is b for a, b in zip(memo[1], sources)): return memo[2]
+    df = get_merged_data(
         dept, target_semester=None, target_grade=None, 
         use_history=use_hist, pad_curriculum=False
     )
+    if sources: st.session_state['preview_memo'] = (key, sources, df)
+    return df
 
 # --- 6. 輔助：取得所有課程名稱列表 ---
+# 結果存於 session_state['course_list']；載入或增刪改 data 後 pop 掉，下次呼叫才重算
 def get_course_list():
+    if 'course_list' in st.session_state: return st.session_state['course_list']
     courses = set()
     if 'data' in st.session_state and not st.session_state['data'].empty:
         if '課程名稱' in st.session_state['data'].columns:
             courses.update(st.session_state['data']['課程名稱'].unique().tolist())
     if 'curr_course_options' in st.session_state:
         courses.update(st.session_state['curr_course_options'])
-    return sorted(list(courses))
+    st.session_state['course_list'] = sorted(courses)
+    return st.session_state['course_list']
 
 # --- 7. 存檔與同步 ---
+def locate_submission_row(ws_sub, target_uuid):
+    """依 sub_row_index 推得 uuid 所在列，只讀表頭與該列確認；回傳 (表頭, 列號)，不中回傳 None"""
+    row_idx = st.session_state.get('sub_row_index', {}).get(target_uuid) if target_uuid else None
+    if not row_idx: return None
+    try: resp = safe_api_call(ws_sub.batch_get, ['1:1', f'{row_idx}:{row_idx}'])
+    except Exception: return None
+    if not resp: return None
+    header_rng, row_rng = resp
+    headers = [str(h).strip() for h in (header_rng[0] if header_rng else [])]
+    row = row_rng[0] if row_rng else []
+    if "uuid" not in headers: return None
+    i = headers.index("uuid")
+    return (headers, row_idx) if i < len(row) and row[i] == target_uuid else None
+
+def find_submission_row(ws_sub, target_uuid):
+    """索引不中時的備援：只讀表頭與 uuid 欄 (不下載整張表) 找列號；回傳 (表頭, 列號)，找不到列號為 -1，讀取失敗回傳 None"""
+    resp = safe_api_call(ws_sub.batch_get, ['1:1', 'A:A'])
+    if not resp: return None
+    header_rng, col_rng = resp
+    headers = [str(h).strip() for h in (header_rng[0] if header_rng else [])]
+    if not target_uuid or "uuid" not in headers: return headers, -1
+    i = headers.index("uuid")
+    # uuid 通常在 A 欄，同一次 batchGet 已取回；否則再單獨讀該欄
+    uuids = [r[0] if r else "" for r in col_rng] if i == 0 else safe_api_call(ws_sub.col_values, i + 1)
+    # 讀取失敗不可當成「找不到」，否則存檔會誤新增重複列
+    if uuids is None: return None
+    for row_idx, val in enumerate(uuids[1:], start=2):
+        if val == target_uuid: return headers, row_idx
+    return headers, -1
+
 def save_single_row(row_data, original_key=None):
-    client = get_connection()
-    if not client: return False
-    
-    sh = client.open(SPREADSHEET_NAME)
-    try: ws_sub = sh.worksheet(SHEET_SUBMISSION)
-    except:
-        ws_sub = sh.add_worksheet(title=SHEET_SUBMISSION, rows=1000, cols=20)
-        ws_sub.append_row(["uuid", "填報時間", "學年度", "科別", "學期", "年級", "課程名稱", "教科書(1)", "冊次(1)", "出版社(1)", "字號(1)", "教科書(2)", "冊次(2)", "出版社(2)", "字號(2)", "適用班級", "備註1", "備註2"])
+    ws_sub = get_ws(SHEET_SUBMISSION)
+    if not ws_sub: return False
 
-    all_values = safe_get_all_values(ws_sub)
-    FULL_HEADERS = ["uuid", "填報時間", "學年度", "科別", "學期", "年級", "課程名稱", "教科書(1)", "冊次(1)", "出版社(1)", "字號(1)", "教科書(2)", "冊次(2)", "出版社(2)", "字號(2)", "適用班級", "備註1", "備註2"]
+    FULL_HEADERS = SUBMISSION_HEADERS
+    target_uuid = row_data.get('uuid')
 
-    if not all_values:
+    # 先只讀表頭與索引指到的那一列；索引沒有或已失效 (他人增刪列) 才讀表頭與 uuid 欄掃描
+    located = locate_submission_row(ws_sub, target_uuid) or find_submission_row(ws_sub, target_uuid)
+    if not located: return False
+    headers, target_row_index = located
+    if not headers:
         ws_sub.append_row(FULL_HEADERS)
-        all_values = [FULL_HEADERS]
-    
-    headers = [str(h).strip() for h in all_values[0]]
-    if "教科書(2)" not in headers or "備註2" not in headers:
-        ws_sub.update(range_name="A1", values=[FULL_HEADERS])
         headers = FULL_HEADERS
-        all_values[0] = FULL_HEADERS
+    
+    # 舊版表頭需補齊時，改寫動作併入下方同一次寫入
+    fix_header = "教科書(2)" not in headers or "備註2" not in headers
+    if fix_header: headers = FULL_HEADERS
 
-    col_map = {h: i for i, h in enumerate(headers)}
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    target_uuid = row_data.get('uuid')
     current_school_year = st.session_state.get("current_school_year", "")
 
     data_dict = {
@@ -483,67 +657,53 @@ def save_single_row(row_data, original_key=None):
         "適用班級": row_data['適用班級'], "備註1": row_data.get('備註1', ''), "備註2": row_data.get('備註2', '')
     }
     
-    row_to_write = []
-    for h in headers:
-        val = ""
-        if h in data_dict: val = data_dict[h]
-        elif h in ["字號(1)", "字號", "審定字號"]: val = data_dict.get("字號(1)", "")
-        elif h == "字號(2)": val = data_dict.get("字號(2)", "")
-        elif h == "備註": val = data_dict.get("備註1", "")
-        row_to_write.append(val)
-
-    target_row_index = -1
-    if target_uuid and "uuid" in col_map:
-        uuid_idx = col_map["uuid"]
-        for i in range(1, len(all_values)):
-            if all_values[i][uuid_idx] == target_uuid:
-                target_row_index = i + 1
-                break
+    row_to_write = [data_dict.get(SUBMISSION_WRITE_ALIASES.get(h, h), "") for h in headers]
 
     if target_row_index > 0:
-        start, end = 'A', chr(ord('A') + len(headers) - 1)
-        if len(headers) > 26: end = 'Z'
-        ws_sub.update(range_name=f"{start}{target_row_index}:{end}{target_row_index}", values=[row_to_write])
+        row_range = f"{rowcol_to_a1(target_row_index, 1)}:{rowcol_to_a1(target_row_index, len(headers))}"
+        writes = [{'range': row_range, 'values': [row_to_write]}]
+        if fix_header: writes.insert(0, {'range': "A1", 'values': [FULL_HEADERS]})
+        # 表頭與該列以單一 values.batchUpdate 寫入
+        ws_sub.batch_update(writes, value_input_option='RAW')
     else:
-        ws_sub.append_row(row_to_write)
+        if fix_header: ws_sub.update(range_name="A1", values=[FULL_HEADERS])
+        resp = ws_sub.append_row(row_to_write, value_input_option='RAW', insert_data_option='INSERT_ROWS', table_range='A1')
+        # 由回應的寫入範圍取得新列號，下次存同一列即可直接定位
+        m = re.search(r'(\d+)(?::[A-Z]+\d+)?$', (resp or {}).get('updates', {}).get('updatedRange', ''))
+        if m and target_uuid: st.session_state.setdefault('sub_row_index', {})[target_uuid] = int(m.group(1))
+    get_cached_submission.clear()
     return True
 
 def delete_row_from_db(target_uuid):
     if not target_uuid: return False
-    client = get_connection()
-    if not client: return False
-    try: ws_sub = client.open(SPREADSHEET_NAME).worksheet(SHEET_SUBMISSION)
-    except: return False
-    all_values = safe_get_all_values(ws_sub)
-    if not all_values: return False
-    headers = [str(h).strip() for h in all_values[0]]
-    if "uuid" not in headers: return False 
-    uuid_idx = headers.index("uuid")
-    target_row_index = -1
-    for i in range(1, len(all_values)):
-        if all_values[i][uuid_idx] == target_uuid:
-            target_row_index = i + 1
-            break
+    try: ws_sub = get_ws(SHEET_SUBMISSION)
+    except Exception: return False
+    if not ws_sub: return False
+    located = locate_submission_row(ws_sub, target_uuid) or find_submission_row(ws_sub, target_uuid)
+    if not located: return False
+    target_row_index = located[1]
     if target_row_index > 0:
         ws_sub.delete_rows(target_row_index)
+        # 其下各列已上移一列，索引同步減一 (之後使用前仍會驗證)
+        row_index = st.session_state.get('sub_row_index')
+        if row_index is not None:
+            row_index.pop(target_uuid, None)
+            st.session_state['sub_row_index'] = {k: (v - 1 if v > target_row_index else v) for k, v in row_index.items()}
+        get_cached_submission.clear()
         return True
     return False
 
 # 🔥 補回 sync_history_to_db，供 PDF 產生前調用
 def sync_history_to_db(dept, history_year):
-    client = get_connection()
-    if not client: return False
     try:
-        sh = client.open(SPREADSHEET_NAME)
-        ws_hist = sh.worksheet(SHEET_HISTORY)
-        ws_sub = sh.worksheet(SHEET_SUBMISSION)
+        ws_sub = get_ws(SHEET_SUBMISSION)
+        if not ws_sub: return False
         
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         current_school_year = st.session_state.get("current_school_year", "")
         if not history_year: return True
 
         data_sub = safe_get_all_values(ws_sub)
-        FULL_HEADERS = ["uuid", "填報時間", "學年度", "科別", "學期", "年級", "課程名稱", "教科書(1)", "冊次(1)", "出版社(1)", "字號(1)", "教科書(2)", "冊次(2)", "出版社(2)", "字號(2)", "適用班級", "備註1", "備註2"]
+        FULL_HEADERS = SUBMISSION_HEADERS
 
         if data_sub:
              sub_headers = [str(h).strip() for h in data_sub[0]]
@@ -558,11 +718,9 @@ def sync_history_to_db(dept, history_year):
 
         existing_uuids = set(df_sub['uuid'].astype(str).str.strip().tolist()) if not df_sub.empty and 'uuid' in df_sub.columns else set()
 
-        data_hist = ws_hist.get_all_records()
-        df_hist = pd.DataFrame(data_hist)
+        _, df_hist = get_reference_frames()
         if df_hist.empty: return True
 
-        df_hist['學年度'] = df_hist['學年度'].astype(str)
         if '科別' not in df_hist.columns:
             st.error("History 缺少'科別'欄位")
             return False
@@ -571,58 +729,67 @@ def sync_history_to_db(dept, history_year):
         if target_year_str == "未填寫": target_year_str = ""
 
         target_rows = df_hist[
-            (df_hist['學年度'].str.strip() == target_year_str) & 
-            (df_hist['科別'].str.strip() == dept.strip())
+            (df_hist['學年度'] == target_year_str) & 
+            (df_hist['科別'] == dept.strip())
         ]
 
         if len(target_rows) == 0: return True
 
-        rows_to_append = []
-        for _, row in target_rows.iterrows():
-            h_uuid = str(row.get('uuid', '')).strip()
-            # 只有當 UUID 不在 Submission 時才寫入
-            if h_uuid in existing_uuids: continue 
-
-            def get_val(keys):
-                for k in keys:
-                    if k in row and str(row[k]).strip(): return str(row[k]).strip()
-                return ""
-
-            row_dict = {
-                "uuid": h_uuid, "填報時間": timestamp, "學年度": current_school_year,
-                "科別": row.get('科別', dept),
-                "學期": str(row.get('學期', '')), "年級": str(row.get('年級', '')), "課程名稱": row.get('課程名稱', ''),
-                "教科書(1)": get_val(['教科書(優先1)', '教科書(1)', '教科書']), "冊次(1)": get_val(['冊次(1)', '冊次']), "出版社(1)": get_val(['出版社(1)', '出版社']), "字號(1)": get_val(['審定字號(1)', '字號(1)']),
-                "教科書(2)": get_val(['教科書(優先2)', '教科書(2)']), "冊次(2)": get_val(['冊次(2)']), "出版社(2)": get_val(['出版社(2)']), "字號(2)": get_val(['審定字號(2)', '字號(2)']),
-                "適用班級": row.get('適用班級', ''), "備註1": get_val(['備註1', '備註']), "備註2": get_val(['備註2'])
-            }
-            new_row_list = []
-            for header in sub_headers:
-                val = row_dict.get(header, "")
-                if not val:
-                    if header == "教科書(1)": val = row_dict.get("教科書(1)")
-                    elif header == "字號(1)": val = row_dict.get("字號(1)")
-                new_row_list.append(val)
-            rows_to_append.append(new_row_list)
-
-        if rows_to_append: ws_sub.append_rows(rows_to_append)
+        # 只有當 UUID 不在 Submission 時才寫入
+        h_uuids = target_rows['uuid'].astype(str).str.strip() if 'uuid' in target_rows.columns else pd.Series('', index=target_rows.index)
+        keep = ~h_uuids.isin(existing_uuids)
+        target_rows, h_uuids = target_rows[keep], h_uuids[keep]
+
+        # 教科書/字號/備註 的舊欄名已在 normalize_df 依 HEADER_ALIASES 轉為標準欄名；
+        # 冊次/出版社 未列入別名 (重複時需編為 冊次(2)/出版社(2))，仍依序取第一個非空白的欄位
+        def get_col(*keys):
+            out = pd.Series('', index=target_rows.index)
+            for k in reversed(keys):
+                if k in target_rows.columns:
+                    v = target_rows[k].astype(str).str.strip()
+                    out = v.where(v != '', out)
+            return out
+
+        def raw_col(key, default=''):
+            return target_rows[key].astype(str) if key in target_rows.columns else default
+
+        # 填報時間/學年度為純量，由 DataFrame 建構時整欄廣播，不逐列組 list
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        df_out = pd.DataFrame({
+            "uuid": h_uuids, "填報時間": timestamp, "學年度": current_school_year,
+            "科別": raw_col('科別', dept),
+            "學期": raw_col('學期'), "年級": raw_col('年級'), "課程名稱": raw_col('課程名稱'),
+            "教科書(1)": get_col('教科書(優先1)'), "冊次(1)": get_col('冊次(1)', '冊次'), "出版社(1)": get_col('出版社(1)', '出版社'), "字號(1)": get_col('審定字號(1)'),
+            "教科書(2)": get_col('教科書(優先2)'), "冊次(2)": get_col('冊次(2)'), "出版社(2)": get_col('出版社(2)'), "字號(2)": get_col('審定字號(2)'),
+            "適用班級": raw_col('適用班級'), "備註1": get_col('備註1'), "備註2": get_col('備註2')
+        }, index=target_rows.index)
+        rows_to_append = df_out.reindex(columns=sub_headers, fill_value="").to_numpy().tolist()
+
+        if rows_to_append:
+            ws_sub.append_rows(rows_to_append, value_input_option='RAW', insert_data_option='INSERT_ROWS', table_range='A1')
+            get_cached_submission.clear()
         return True 
     except Exception as e:
         st.error(f"同步失敗: {e}")
         return False
 
 # --- 8. PDF 報表 ---
-def create_pdf_report(dept):
+def create_pdf_report(dept, df, current_year, printed_at):
+    """由 load_preview_data 的結果產生 PDF；所需資料全由參數傳入，不讀 session_state"""
     CHINESE_FONT = 'NotoSans' 
-    current_year = st.session_state.get('current_school_year', '114')
 
     class PDF(FPDF):
+        def set_font(self, family=None, style="", size=0):
+            # 粗/斜體本來就是同一個一般字型檔，只註冊一次，樣式一律用一般 (Helvetica 備援時保留樣式)
+            if family == CHINESE_FONT and CHINESE_FONT != 'Helvetica': style = ''
+            super().set_font(family, style, size)
+
         def header(self):
             self.set_auto_page_break(False)
             self.set_font(CHINESE_FONT, 'B', 18) 
             self.cell(0, 10, f'{dept} {current_year}學年度 教科書選用總表', new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
             self.set_font(CHINESE_FONT, '', 10)
-            self.cell(0, 5, f"列印時間：{datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
+            self.cell(0, 5, f"列印時間：{printed_at}", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
             self.ln(5)
             self.set_auto_page_break(True, margin=15)
 
@@ -631,18 +798,22 @@ def create_pdf_report(dept):
             self.set_font(CHINESE_FONT, 'I', 8)
             self.cell(0, 10, f'Page {self.page_no()}/{{nb}}', new_x=XPos.RIGHT, new_y=YPos.TOP, align='C')
     
-    df = load_preview_data(dept) 
     if df.empty: return None
     
     df = df.sort_values(by='填報時間', ascending=True)
     df = df.drop_duplicates(subset=['uuid'], keep='last')
     
+    # 表格文字欄整欄先去空白、換行轉空白，逐列繪製時直接取用
+    for col in ['教科書(優先1)', '冊次(1)', '出版社(1)', '審定字號(1)', '教科書(優先2)', '冊次(2)', '出版社(2)', '審定字號(2)']:
+        df[col] = df[col].astype(str).str.strip().str.translate(_FLATTEN_LINES)
+    row_text_cols = ['課程名稱', '適用班級', '教科書(優先1)', '冊次(1)', '出版社(1)', '審定字號(1)', '教科書(優先2)', '冊次(2)', '出版社(2)', '審定字號(2)']
+    df['_r1'], df['_r2'] = clean_note_columns(df)
+    
     pdf = PDF(orientation='L', unit='mm', format='A4') 
     pdf.set_auto_page_break(auto=True, margin=15)
     try:
+        # CJK 字型解析很重 (每次約 0.4 秒)，只載入一次；重複列印由 get_cached_pdf_report 直接回傳
         pdf.add_font(CHINESE_FONT, '', 'NotoSansCJKtc-Regular.ttf') 
-        pdf.add_font(CHINESE_FONT, 'B', 'NotoSansCJKtc-Regular.ttf') 
-        pdf.add_font(CHINESE_FONT, 'I', 'NotoSansCJKtc-Regular.ttf') 
     except Exception: CHINESE_FONT = 'Helvetica'
         
     pdf.add_page()
@@ -657,6 +828,10 @@ def create_pdf_report(dept):
         col_widths[5] = 44   # 字號 38+6
 
     LINE_HEIGHT = 5.5 
+
+    def count_lines(text, w):
+        txt_w = pdf.get_string_width(text)
+        return math.ceil(txt_w / (w-2)) if txt_w > 0 else 1
     
     def render_table_header(pdf):
         auto_pb = pdf.auto_page_break
@@ -674,51 +849,26 @@ def create_pdf_report(dept):
         if auto_pb: pdf.set_auto_page_break(True, margin=15)
 
     for sem in sorted(df['學期'].unique()):
-        sem_df = df[df['學期'] == sem].copy()
+        sem_df = df[df['學期'] == sem]
         pdf.set_font(CHINESE_FONT, 'B', 14)
         pdf.set_fill_color(200, 220, 255)
         pdf.cell(sum(col_widths), 10, f"第 {sem} 學期", border=1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='L', fill=True)
         if not sem_df.empty:
             sem_df = sem_df.sort_values(by=['年級', '課程名稱']) 
             render_table_header(pdf)
-            for _, row in sem_df.iterrows():
-                b1 = str(row.get('教科書(優先1)') or row.get('教科書(1)', '')).strip()
-                v1, p1 = str(row.get('冊次(1)', '')).strip(), str(row.get('出版社(1)', '')).strip()
-                c1 = str(row.get('審定字號(1)') or row.get('字號(1)', '')).strip()
-                r1, r2 = safe_note(row)
-                b2 = str(row.get('教科書(優先2)') or row.get('教科書(2)', '')).strip()
-                v2, p2 = str(row.get('冊次(2)', '')).strip(), str(row.get('出版社(2)', '')).strip()
-                c2 = str(row.get('審定字號(2)') or row.get('字號(2)', '')).strip()
-                has_priority_2 = (b2 != "" or v2 != "")
-                def clean(s): return s.replace('\r', '').replace('\n', ' ')
-                p1_data = [str(row['課程名稱']), str(row['適用班級']), clean(b1), clean(v1), clean(p1), clean(c1), clean(r1), ""]
-                p2_data = ["", "", clean(b2), clean(v2), clean(p2), clean(c2), clean(r2), ""]
+            # 直接 zip 各欄 list 逐列取值，不為每列建立 Series
+            row_cols = [sem_df[c].tolist() for c in row_text_cols + ['_r1', '_r2']]
+            # 是否有第二優先整欄一次算好，不在迴圈內逐列判斷
+            has_p2_col = ((sem_df['教科書(優先2)'] != "") | (sem_df['冊次(2)'] != "")).tolist()
+            for has_priority_2, (course, classes, b1, v1, p1, c1, b2, v2, p2, c2, r1, r2) in zip(has_p2_col, zip(*row_cols)):
+                p1_data = [str(course), str(classes), b1, v1, p1, c1, r1, ""]
+                p2_data = ["", "", b2, v2, p2, c2, r2, ""]
 
                 pdf.set_font(CHINESE_FONT, '', 12) 
-                lines_p1 = []
-                for i, text in enumerate(p1_data):
-                    w = col_widths[i]
-                    txt_w = pdf.get_string_width(text)
-                    lines = math.ceil(txt_w / (w-2)) if txt_w > 0 else 1
-                    if text == "": lines = 0
-                    if i in [0, 1]: lines = 0
-                    lines_p1.append(lines)
-                
-                lines_p2 = []
-                for i, text in enumerate(p2_data):
-                    w = col_widths[i]
-                    txt_w = pdf.get_string_width(text)
-                    lines = math.ceil(txt_w / (w-2)) if txt_w > 0 else 1
-                    if text == "": lines = 0
-                    lines_p2.append(lines)
-                
-                lines_common = []
-                for i in [0, 1]:
-                    w = col_widths[i]
-                    text = p1_data[i]
-                    txt_w = pdf.get_string_width(text)
-                    lines = math.ceil(txt_w / (w-2)) if txt_w > 0 else 1
-                    lines_common.append(lines)
+                # 空字串不佔行，不必量字寬；課程名稱/班級跨兩段，只在 lines_common 量一次
+                lines_p1 = [0, 0] + [count_lines(t, w) if t != "" else 0 for t, w in zip(p1_data[2:], col_widths[2:])]
+                lines_p2 = [count_lines(t, w) if t != "" else 0 for t, w in zip(p2_data, col_widths)]
+                lines_common = [count_lines(p1_data[i], col_widths[i]) for i in [0, 1]]
 
                 max_h_p1 = max(lines_p1) * LINE_HEIGHT + 2
                 max_h_p2 = max(lines_p2) * LINE_HEIGHT + 2 if has_priority_2 else 0
@@ -783,6 +933,13 @@ def create_pdf_report(dept):
     pdf.ln()
     return pdf.output()
 
+# 以報表資料本身的雜湊為鍵：存檔/刪除/同步後資料一變就換鍵，不靠外部時間戳
+# 列印時間 (到分鐘) 也列入鍵，快取的 PDF 不會印出過時的時間；_df 不參與雜湊
+@st.cache_data(ttl=120, max_entries=16, show_spinner=False)
+def get_cached_pdf_report(dept, current_year, printed_at, df_hash, _df):
+    pdf_bytes = create_pdf_report(dept, _df, current_year, printed_at)
+    return bytes(pdf_bytes) if pdf_bytes else None
+
 # --- 9. Callbacks ---
 def auto_load_data():
     dept = st.session_state.get('dept_val')
@@ -833,6 +990,9 @@ def auto_load_data():
         st.session_state['cb_all'] = not is_spec
         update_class_list_from_checkboxes()
 
+        # 先釋放舊的 DataFrame，避免新舊兩份同時佔用記憶體
+        st.session_state.pop('data', None)
+        st.session_state.pop('course_list', None)
         df = load_data(dept, sem, grade, hist_year)
         st.session_state['data'] = df
         st.session_state['loaded'] = True
@@ -840,36 +1000,37 @@ def auto_load_data():
         st.session_state['original_key'] = None
         st.session_state['current_uuid'] = None
         
-        st.session_state['form_data'] = {k: '' for k in ['course','book1','pub1','code1','book2','pub2','code2','note1','note2']}
+        st.session_state['form_data'] = dict.fromkeys(FORM_KEYS, '')
         st.session_state['form_data'].update({'vol1':'全', 'vol2':'全'})
         st.session_state['editor_key_counter'] += 1
 
 def update_class_list_from_checkboxes():
-    dept, grade = st.session_state.get('dept_val'), st.session_state.get('grade_val')
-    cur_set = set(st.session_state.get('class_multiselect', []))
-    def get_classes(sys_name):
-        prefix = {"1": "一", "2": "二", "3": "三"}.get(str(grade), "")
-        suffixes = DEPT_SPECIFIC_CONFIG[dept].get(sys_name, []) if dept in DEPT_SPECIFIC_CONFIG else ALL_SUFFIXES.get(sys_name, [])
-        return [f"{prefix}{s}" for s in suffixes] if not (str(grade)=="3" and sys_name=="建教班") else []
-
-    for k, name in [('cb_reg','普通科'), ('cb_prac','實用技能班'), ('cb_coop','建教班')]:
-        if st.session_state[k]: cur_set.update(get_classes(name))
-        else: cur_set.difference_update(get_classes(name))
+    ss = st.session_state
+    dept, grade = ss.get('dept_val'), ss.get('grade_val')
+    cur_set = set(ss.get('class_multiselect', []))
+    cb = tuple(ss[k] for k, _ in CLASS_CHECKBOXES)
+
+    for checked, (_, name) in zip(cb, CLASS_CHECKBOXES):
+        if checked: cur_set.update(get_target_classes_for_dept(dept, grade, name))
+        else: cur_set.difference_update(get_target_classes_for_dept(dept, grade, name))
     
-    final = sorted(list(cur_set))
-    st.session_state['active_classes'] = final
-    st.session_state['class_multiselect'] = final 
-    st.session_state['cb_all'] = all([st.session_state['cb_reg'], st.session_state['cb_prac'], st.session_state['cb_coop']])
-
-def toggle_all_checkboxes():
-    v = st.session_state['cb_all']
-    for k in ['cb_reg', 'cb_prac', 'cb_coop']: st.session_state[k] = v
+    final = sorted(cur_set)
+    ss['active_classes'] = final
+    ss['class_multiselect'] = final 
+    ss['cb_all'] = all(cb)
+
+def on_class_checkbox_change(cb_key):
+    """四個班級勾選框共用的 callback：一次算出所有勾選框與班級列表"""
+    ss = st.session_state
+    if cb_key == 'cb_all':
+        for k, _ in CLASS_CHECKBOXES: ss[k] = ss['cb_all']
     update_class_list_from_checkboxes()
 
 def on_multiselect_change():
     st.session_state['active_classes'] = st.session_state['class_multiselect']
 
 def on_editor_change():
+    # 只讀 edited_rows 差異並以 .at 逐格回寫 session 中的 data，不讀取整張編輯後的表
     key = f"main_editor_{st.session_state['editor_key_counter']}"
     if key not in st.session_state: return
     edits = st.session_state[key]["edited_rows"]
@@ -896,7 +1057,7 @@ def on_editor_change():
             '科別': row['科別'], '年級': str(row['年級']), '學期': str(row['學期']), 
             '課程名稱': row['課程名稱'], '適用班級': str(row.get('適用班級', ''))
         }
-        st.session_state['current_uuid'] = str(row.get('uuid')).strip()
+        st.session_state['current_uuid'] = row_uuid(row.get('uuid'))
         
         st.session_state['form_data'] = {
             'course': row["課程名稱"],
@@ -904,17 +1065,17 @@ def on_editor_change():
             'book2': row.get("教科書(優先2)", ""), 'vol2': row.get("冊次(2)", ""), 'pub2': row.get("出版社(2)", ""), 'code2': row.get("審定字號(2)", ""),
             'note1': row.get("備註1", ""), 'note2': row.get("備註2", "")
         }
-        cls_list = [c.strip() for c in str(row.get("適用班級", "")).replace("，", ",").split(",") if c.strip()]
+        cls_list = split_classes(row.get("適用班級", ""))
         st.session_state['original_classes'] = cls_list 
         st.session_state['active_classes'] = cls_list
         st.session_state['class_multiselect'] = cls_list
         
         dept, grade = st.session_state.get('dept_val'), st.session_state.get('grade_val')
         cls_set = set(cls_list)
-        for k, sys in [('cb_reg','普通科'), ('cb_prac','實用技能班'), ('cb_coop','建教班')]:
+        for k, sys in CLASS_CHECKBOXES:
             tgts = get_target_classes_for_dept(dept, grade, sys)
-            st.session_state[k] = bool(tgts and set(tgts).intersection(cls_set))
-        st.session_state['cb_all'] = all([st.session_state['cb_reg'], st.session_state['cb_prac'], st.session_state['cb_coop']])
+            st.session_state[k] = not cls_set.isdisjoint(tgts)
+        st.session_state['cb_all'] = all(st.session_state[k] for k, _ in CLASS_CHECKBOXES)
         
         st.session_state['editor_key_counter'] += 1
         return
@@ -924,7 +1085,7 @@ def on_editor_change():
         st.session_state['edit_index'] = None
         st.session_state['current_uuid'] = None
         st.session_state['original_key'] = None
-        st.session_state['form_data'] = {k: '' for k in ['course','book1','pub1','code1','book2','pub2','code2','note1','note2']}
+        st.session_state['form_data'] = dict.fromkeys(FORM_KEYS, '')
         st.session_state['form_data'].update({'vol1':'全', 'vol2':'全'})
         st.session_state['active_classes'] = []
         st.session_state['class_multiselect'] = []
@@ -957,16 +1118,14 @@ def on_preview_change():
         auto_load_data()
         
         current_df = st.session_state['data']
-        matching_indices = []
-        if target_uuid:
-            matching_indices = current_df.index[current_df['uuid'] == target_uuid].tolist()
+        hits = np.flatnonzero(current_df['uuid'].to_numpy() == target_uuid) if target_uuid else np.empty(0, dtype=int)
         
-        if not matching_indices:
+        if not hits.size:
             target_course = row['課程名稱']
-            matching_indices = current_df.index[current_df['課程名稱'] == target_course].tolist()
+            hits = np.flatnonzero(current_df['課程名稱'].to_numpy() == target_course)
         
-        if matching_indices:
-            new_idx = matching_indices[0]
+        if hits.size:
+            new_idx = int(hits[0])
             st.session_state['data'].at[new_idx, "勾選"] = True
             st.session_state['edit_index'] = new_idx
             
@@ -975,7 +1134,7 @@ def on_preview_change():
                 '科別': row_data['科別'], '年級': str(row_data['年級']), '學期': str(row_data['學期']), 
                 '課程名稱': row_data['課程名稱'], '適用班級': str(row_data.get('適用班級', ''))
             }
-            st.session_state['current_uuid'] = str(row_data.get('uuid')).strip()
+            st.session_state['current_uuid'] = row_uuid(row_data.get('uuid'))
             st.session_state['form_data'] = {
                 'course': row_data["課程名稱"],
                 'book1': row_data.get("教科書(優先1)", ""), 'vol1': row_data.get("冊次(1)", ""), 'pub1': row_data.get("出版社(1)", ""), 'code1': row_data.get("審定字號(1)", ""),
@@ -983,7 +1142,7 @@ def on_preview_change():
                 'note1': row_data.get("備註1", ""), 'note2': row_data.get("備註2", "")
             }
             
-            cls_list = [c.strip() for c in str(row_data.get("適用班級", "")).replace("，", ",").split(",") if c.strip()]
+            cls_list = split_classes(row_data.get("適用班級", ""))
             
             st.session_state['original_classes'] = cls_list
             st.session_state['active_classes'] = cls_list
@@ -992,35 +1151,65 @@ def on_preview_change():
             dept, grade = st.session_state.get('dept_val'), st.session_state.get('grade_val')
             cls_set = set(cls_list)
             
-            for k, sys in [('cb_reg','普通科'), ('cb_prac','實用技能班'), ('cb_coop','建教班')]:
+            for k, sys in CLASS_CHECKBOXES:
                 tgts = get_target_classes_for_dept(dept, grade, sys)
-                st.session_state[k] = bool(tgts and set(tgts).intersection(cls_set))
-            st.session_state['cb_all'] = all([st.session_state['cb_reg'], st.session_state['cb_prac'], st.session_state['cb_coop']])
+                st.session_state[k] = not cls_set.isdisjoint(tgts)
+            st.session_state['cb_all'] = all(st.session_state[k] for k, _ in CLASS_CHECKBOXES)
             
             st.session_state['show_preview'] = False
             st.session_state['editor_key_counter'] += 1
 
-# --- 10. 主程式 Entry ---
+# --- 10. 表格欄位設定 (只建立一次，Streamlit 內部會複製後再使用) ---
+@st.cache_resource
+def _preview_column_config():
+    return {
+        "勾選": st.column_config.CheckboxColumn("編輯", width="small"),
+        "uuid": None, "填報時間": None, "學年度": None,
+        "學期": st.column_config.TextColumn("學期", width="small"),
+        "年級": st.column_config.TextColumn("年級", width="small"),
+        "課程名稱": st.column_config.TextColumn("課程名稱", width="medium"),
+        "教科書(優先1)": st.column_config.TextColumn("教科書", width="medium"),
+        "出版社(1)": st.column_config.TextColumn("出版社", width="small"),
+        "適用班級": st.column_config.TextColumn("適用班級", width="medium"),
+        "備註1": st.column_config.TextColumn("備註", width="small"),
+    }
+
+@st.cache_resource
+def _editor_column_config():
+    return {
+        "勾選": st.column_config.CheckboxColumn("勾選", width="small"),
+        "uuid": None, "科別": None, "年級": None, "學期": None,
+        "課程類別": st.column_config.TextColumn("類別", width="small", disabled=True),
+        "課程名稱": st.column_config.TextColumn("課程名稱", width="medium", disabled=True),
+        "適用班級": st.column_config.TextColumn("適用班級", width="medium", disabled=True),
+        "教科書(優先1)": st.column_config.TextColumn("教科書(1)", width="medium", disabled=True),
+        "冊次(1)": st.column_config.TextColumn("冊次(1)", width="small", disabled=True),
+        "出版社(1)": st.column_config.TextColumn("出版社(1)", width="small", disabled=True),
+        "備註1": st.column_config.TextColumn("備註", width="small", disabled=True),
+        "教科書(優先2)": st.column_config.TextColumn("教科書(2)", width="medium", disabled=True),
+        "冊次(2)": st.column_config.TextColumn("冊次(2)", width="small", disabled=True),
+        "出版社(2)": st.column_config.TextColumn("出版社(2)", width="small", disabled=True),
+        "備註2": st.column_config.TextColumn("備註2", width="small", disabled=True),
+        "審定字號(1)": st.column_config.TextColumn("字號(1)", width="small", disabled=True),
+        "審定字號(2)": st.column_config.TextColumn("字號(2)", width="small", disabled=True),
+    }
+
+# --- 11. 主程式 Entry ---
 def main():
     st.set_page_config(page_title="教科書填報系統", layout="wide")
     if not check_login(): st.stop()
     
     st.markdown("""<style>div[data-testid="stDataEditor"] {background-color: #ffffff !important;} div[data-testid="column"] button {margin-top: 1.5rem;}</style>""", unsafe_allow_html=True)
 
-    for k in ['edit_index', 'current_uuid', 'last_selected_row']: 
-        if k not in st.session_state: st.session_state[k] = None
-    if 'active_classes' not in st.session_state: st.session_state['active_classes'] = []
-    if 'form_data' not in st.session_state: st.session_state['form_data'] = {k: '' for k in ['course','book1','pub1','code1','book2','pub2','code2','note1','note2']}
-    if 'editor_key_counter' not in st.session_state: st.session_state['editor_key_counter'] = 0
-    if 'use_history_checkbox' not in st.session_state: st.session_state['use_history_checkbox'] = False
-    if 'show_preview' not in st.session_state: st.session_state['show_preview'] = False
-    if 'last_dept' not in st.session_state: st.session_state['last_dept'] = None
-    if 'last_grade' not in st.session_state: st.session_state['last_grade'] = None
+    ss = st.session_state
+    for k, v in SESSION_DEFAULTS.items():
+        if k not in ss: ss[k] = v
+    if 'active_classes' not in ss: ss['active_classes'] = []
+    if 'form_data' not in ss: ss['form_data'] = dict.fromkeys(FORM_KEYS, '')
 
     with st.sidebar:
         st.header("1. 填報設定")
-        depts = ["建築科", "機械科", "電機科", "製圖科", "室設科", "國文科", "英文科", "數學科", "自然科", "社會科", "資訊科技", "體育科", "國防科", "藝術科", "健護科", "輔導科", "閩南語"]
-        dept = st.selectbox("科別", depts, key='dept_val', on_change=auto_load_data)
+        dept = st.selectbox("科別", DEPT_OPTIONS, key='dept_val', on_change=auto_load_data)
         c1, c2 = st.columns(2)
         sem = c1.selectbox("學期", ["1", "2", "寒", "暑", "返"], key='sem_val', on_change=auto_load_data)
         grade = c2.selectbox("年級", ["1", "2", "3"], key='grade_val', on_change=auto_load_data)
@@ -1036,6 +1225,12 @@ def main():
         st.divider()
         if st.button("🧹 強制清除快取"):
             st.cache_data.clear()
+            get_reference_frames.clear()
+            get_cached_submission.clear()
+            _open_spreadsheet.clear()
+            _connection_failure.clear()
+            _ws_by_title.clear()
+            _open_ws.clear()
             st.success("快取已清除！")
             time.sleep(1)
             st.rerun()
@@ -1052,7 +1247,7 @@ def main():
                          st.session_state['data'].at[st.session_state['edit_index'], "勾選"] = False
                     st.session_state['edit_index'] = None
                     st.session_state['current_uuid'] = None
-                    st.session_state['form_data'] = {k: '' for k in ['course','book1','pub1','code1','book2','pub2','code2','note1','note2']}
+                    st.session_state['form_data'] = dict.fromkeys(FORM_KEYS, '')
                     st.session_state['editor_key_counter'] += 1
         
         with c_pdf:
@@ -1066,10 +1261,14 @@ def main():
                                 if sync_history_to_db(dept, hist_year): st.success("✅ 資料同步完成")
                                 else: st.error("❌ 同步失敗")
                         
-                        pdf_bytes = create_pdf_report(dept)
+                        df_report = load_preview_data(dept)
+                        df_hash = int(pd.util.hash_pandas_object(df_report).sum()) if not df_report.empty else 0
+                        pdf_bytes = get_cached_pdf_report(dept, st.session_state.get('current_school_year', '114'),
+                                                          datetime.datetime.now().strftime('%Y-%m-%d %H:%M'), df_hash, df_report)
                         if pdf_bytes:
-                            b64 = base64.b64encode(pdf_bytes).decode('latin-1')
-                            st.markdown(f'<a href="data:application/pdf;base64,{b64}" download="{dept}_教科書總表.pdf" style="text-decoration:none; color:white; background-color:#b31412; padding:8px 12px; border-radius:5px; font-weight:bold; font-size:14px; display:block; text-align:center;">⬇️ 點此下載 PDF</a>', unsafe_allow_html=True)
+                            # 由 Streamlit 媒體端點傳送檔案，不把 base64 內嵌進頁面；點擊下載不觸發 rerun
+                            st.download_button("⬇️ 點此下載 PDF", data=bytes(pdf_bytes), file_name=f"{dept}_教科書總表.pdf",
+                                               mime="application/pdf", type="primary", width='stretch', on_click="ignore")
                         else: st.error("生成失敗，Submission 無資料。")
                 else: st.warning("請先選擇科別")
 
@@ -1084,23 +1283,16 @@ def main():
                 key="preview_editor",
                 on_change=on_preview_change,
                 width='stretch',
-                column_config={
-                    "勾選": st.column_config.CheckboxColumn("編輯", width="small"),
-                    "uuid": None, "填報時間": None, "學年度": None,
-                    "學期": st.column_config.TextColumn("學期", width="small"),
-                    "年級": st.column_config.TextColumn("年級", width="small"),
-                    "課程名稱": st.column_config.TextColumn("課程名稱", width="medium"),
-                    "教科書(優先1)": st.column_config.TextColumn("教科書", width="medium"),
-                    "出版社(1)": st.column_config.TextColumn("出版社", width="small"),
-                    "適用班級": st.column_config.TextColumn("適用班級", width="medium"),
-                    "備註1": st.column_config.TextColumn("備註", width="small"),
-                },
-                disabled=["科別", "學期", "年級", "課程名稱", "教科書(優先1)", "冊次(1)", "出版社(1)", "審定字號(1)", "教科書(優先2)", "冊次(2)", "出版社(2)", "審定字號(2)", "適用班級", "備註1", "備註2"],
-                column_order=["勾選", "學期", "年級", "課程名稱", "教科書(優先1)", "出版社(1)", "適用班級", "備註1"]
+                column_config=_preview_column_config(),
+                disabled=PREVIEW_DISABLED,
+                column_order=PREVIEW_COLUMN_ORDER
             )
         else:
             st.warning("⚠️ 目前沒有任何資料。")
         st.divider()
+    else:
+        st.session_state.pop('preview_df', None)
+        st.session_state.pop('preview_memo', None)
 
     if 'loaded' not in st.session_state and dept and sem and grade: auto_load_data()
 
@@ -1113,13 +1305,15 @@ def main():
             if is_edit:
                 c_can, c_del = st.columns([1, 1])
                 if c_can.button("❌ 取消", type="secondary"):
+                    # 勾選欄只有編輯中的那一列為 True，清掉該格即可，不整欄重寫
+                    st.session_state['data'].at[st.session_state['edit_index'], "勾選"] = False
                     st.session_state['edit_index'] = None
-                    st.session_state['data']["勾選"] = False
                     st.session_state['editor_key_counter'] += 1
                     st.rerun()
                 if c_del.button("🗑️ 刪除此列", type="primary"):
                     if delete_row_from_db(st.session_state.get('current_uuid')):
                         st.session_state['data'] = st.session_state['data'].drop(st.session_state['edit_index']).reset_index(drop=True)
+                        st.session_state.pop('course_list', None)
                         st.session_state['edit_index'] = None
                         st.session_state['editor_key_counter'] += 1
                         st.success("已刪除！")
@@ -1132,12 +1326,15 @@ def main():
             
             st.markdown("##### 適用班級")
             ca, c1, c2, c3 = st.columns([1,1,1,1])
-            ca.checkbox("全部", key="cb_all", on_change=toggle_all_checkboxes)
-            c1.checkbox("普通", key="cb_reg", on_change=update_class_list_from_checkboxes)
-            c2.checkbox("實技", key="cb_prac", on_change=update_class_list_from_checkboxes)
-            c3.checkbox("建教", key="cb_coop", on_change=update_class_list_from_checkboxes)
+            ca.checkbox("全部", key="cb_all", on_change=on_class_checkbox_change, args=('cb_all',))
+            c1.checkbox("普通", key="cb_reg", on_change=on_class_checkbox_change, args=('cb_reg',))
+            c2.checkbox("實技", key="cb_prac", on_change=on_class_checkbox_change, args=('cb_prac',))
+            c3.checkbox("建教", key="cb_coop", on_change=on_class_checkbox_change, args=('cb_coop',))
             
             poss = get_all_possible_classes(grade)
+            valid_cls = get_valid_class_set(grade)
+            extra_cls = {c for c in st.session_state['active_classes'] if c not in valid_cls}
+            cls_options = tuple(sorted(extra_cls.union(poss))) if extra_cls else poss
             
             # --- FIX: Removed 'default' parameter to fix session state warning ---
             if "class_multiselect" not in st.session_state:
@@ -1145,80 +1342,91 @@ def main():
 
             sel_cls = st.multiselect(
                 "最終班級列表:", 
-                options=sorted(list(set(poss + st.session_state['active_classes']))), 
+                options=cls_options, 
                 key="class_multiselect", 
                 on_change=on_multiselect_change
             )
             # -------------------------------------------------------------------
 
-            inp_cls_str = ",".join(sel_cls)
-
-            st.markdown("**第一優先**")
-            inp_bk1 = st.text_input("書名", value=frm['book1'])
-            b1, b2 = st.columns([1, 2])
-            inp_vol1 = b1.selectbox("冊次", ["全", "上", "下", "I", "II", "III", "IV", "V", "VI"], index=["全", "上", "下", "I", "II", "III", "IV", "V", "VI"].index(frm.get('vol1','全')) if frm.get('vol1') in ["全", "上", "下", "I", "II", "III", "IV", "V", "VI"] else 0)
-            inp_pub1 = b2.text_input("出版社", value=frm['pub1'])
-            c1, n1 = st.columns(2)
-            inp_cod1 = c1.text_input("審定字號", value=frm['code1'])
-            inp_nt1 = n1.text_input("備註1(作者/單價)", value=frm['note1'])
-
-            st.markdown("**第二優先**")
-            inp_bk2 = st.text_input("備選書名", value=frm['book2'])
-            b3, b4 = st.columns([1, 2])
-            inp_vol2 = b3.selectbox("冊次(2)", ["全", "上", "下", "I", "II", "III", "IV", "V", "VI"], index=["全", "上", "下", "I", "II", "III", "IV", "V", "VI"].index(frm.get('vol2','全')) if frm.get('vol2') in ["全", "上", "下", "I", "II", "III", "IV", "V", "VI"] else 0)
-            inp_pub2 = b4.text_input("出版社(2)", value=frm['pub2'])
-            c2, n2 = st.columns(2)
-            inp_cod2 = c2.text_input("審定字號(2)", value=frm['code2'])
-            inp_nt2 = n2.text_input("備註2(作者/單價)", value=frm['note2'])
-
-            if st.button("🔄 更新 (存檔)" if is_edit else "➕ 加入 (存檔)", type="primary", width="stretch"):
-                if not inp_cls_str or not inp_bk1 or not inp_pub1 or not inp_vol1: st.error("⚠️ 班級、書名、冊次、出版社必填")
-                else:
-                    uid = st.session_state.get('current_uuid') if is_edit else str(uuid.uuid4())
-                    row = {
-                        "uuid": uid, "科別": dept, "年級": grade, "學期": sem, "課程類別": "部定必修", "課程名稱": inp_course,
-                        "教科書(優先1)": inp_bk1, "冊次(1)": inp_vol1, "出版社(1)": inp_pub1, "審定字號(1)": inp_cod1,
-                        "教科書(優先2)": inp_bk2, "冊次(2)": inp_vol2, "出版社(2)": inp_pub2, "審定字號(2)": inp_cod2,
-                        "適用班級": inp_cls_str, "備註1": inp_nt1, "備註2": inp_nt2
-                    }
-                    if is_edit: save_single_row(row, st.session_state.get('original_key'))
-                    else: save_single_row(row, None)
-                    
-                    if is_edit:
-                        for k, v in row.items():
-                            if k in st.session_state['data'].columns: st.session_state['data'].at[st.session_state['edit_index'], k] = v
-                        st.session_state['data'].at[st.session_state['edit_index'], "勾選"] = False
+            # 書籍欄位放進 form：打字不觸發整頁重跑，按存檔時才一次送出
+            # (班級勾選/多選有 on_change 連動，form 內不允許，維持在外面)
+            with st.form("book_form", border=False):
+                st.markdown("**第一優先**")
+                inp_bk1 = st.text_input("書名", value=frm['book1'])
+                b1, b2 = st.columns([1, 2])
+                inp_vol1 = b1.selectbox("冊次", VOL_OPTS, index=VOL_IDX.get(frm.get('vol1'), 0))
+                inp_pub1 = b2.text_input("出版社", value=frm['pub1'])
+                c1, n1 = st.columns(2)
+                inp_cod1 = c1.text_input("審定字號", value=frm['code1'])
+                inp_nt1 = n1.text_input("備註1(作者/單價)", value=frm['note1'])
+
+                st.markdown("**第二優先**")
+                inp_bk2 = st.text_input("備選書名", value=frm['book2'])
+                b3, b4 = st.columns([1, 2])
+                inp_vol2 = b3.selectbox("冊次(2)", VOL_OPTS, index=VOL_IDX.get(frm.get('vol2'), 0))
+                inp_pub2 = b4.text_input("出版社(2)", value=frm['pub2'])
+                c2, n2 = st.columns(2)
+                inp_cod2 = c2.text_input("審定字號(2)", value=frm['code2'])
+                inp_nt2 = n2.text_input("備註2(作者/單價)", value=frm['note2'])
+
+                if st.form_submit_button("🔄 更新 (存檔)" if is_edit else "➕ 加入 (存檔)", type="primary", width="stretch"):
+                    if not sel_cls or not inp_bk1 or not inp_pub1 or not inp_vol1: st.error("⚠️ 班級、書名、冊次、出版社必填")
                     else:
-                        row['勾選'] = False
-                        st.session_state['data'] = pd.concat([st.session_state['data'], pd.DataFrame([row])], ignore_index=True)
+                        # 編輯中的列若沒有 uuid (如表格內直接新增的列)，首次存檔時才配發並記住，重存同一列不會再新增一筆
+                        uid = st.session_state.get('current_uuid') if is_edit else None
+                        if not uid:
+                            uid = str(uuid.uuid4())
+                            if is_edit: st.session_state['current_uuid'] = uid
+                        row = {
+                            "uuid": uid, "科別": dept, "年級": grade, "學期": sem, "課程類別": "部定必修", "課程名稱": inp_course,
+                            "教科書(優先1)": inp_bk1, "冊次(1)": inp_vol1, "出版社(1)": inp_pub1, "審定字號(1)": inp_cod1,
+                            "教科書(優先2)": inp_bk2, "冊次(2)": inp_vol2, "出版社(2)": inp_pub2, "審定字號(2)": inp_cod2,
+                            "適用班級": ",".join(sel_cls), "備註1": inp_nt1, "備註2": inp_nt2
+                        }
+                        # 已在 Submission 的列內容完全沒變時不重寫雲端 (課程類別不寫入 Submission，不列入比較)
+                        unchanged = False
+                        if is_edit and uid in st.session_state.get('sub_row_index', {}):
+                            df_data = st.session_state['data']
+                            cmp_cols = [k for k in row if k in df_data.columns and k != "課程類別"]
+                            unchanged = [str(v) for v in df_data.loc[st.session_state['edit_index'], cmp_cols]] == [str(row[k]) for k in cmp_cols]
+                        if unchanged:
+                            st.toast("內容未變更，未重新存檔")
+                            saved = True
+                        else: saved = save_single_row(row, st.session_state.get('original_key') if is_edit else None)
+                        # 雲端沒寫成功：保留表單與編輯狀態，不更新本地表格、不重跑 (以免蓋掉錯誤訊息)
+                        if not saved: st.error("❌ 存檔失敗，資料未寫入雲端，請稍後再試。")
+                        else:
+                            st.session_state.pop('course_list', None)
                     
-                    st.session_state['edit_index'] = None
-                    st.session_state['editor_key_counter'] += 1
-                    st.success("已存檔！")
-                    st.rerun()
+                            if is_edit:
+                                df_data = st.session_state['data']
+                                upd_cols = [k for k in row if k in df_data.columns]
+                                df_data.loc[st.session_state['edit_index'], upd_cols + ["勾選"]] = [row[k] for k in upd_cols] + [False]
+                            else:
+                                row['勾選'] = False
+                                df_data = st.session_state['data']
+                                if df_data.columns.empty:
+                                    st.session_state['data'] = pd.DataFrame([row])
+                                else:
+                                    # 直接在尾端擴一列再填值，不另建單列 DataFrame + concat，且保留既有欄位型別
+                                    n = len(df_data)
+                                    df_data = df_data.reindex(pd.RangeIndex(n + 1))
+                                    df_data.loc[n] = [row.get(c, "") for c in df_data.columns]
+                                    st.session_state['data'] = df_data
+                    
+                            st.session_state['edit_index'] = None
+                            st.session_state['editor_key_counter'] += 1
+                            st.success("已存檔！")
+                            st.rerun()
 
         st.success(f"目前編輯：**{dept}** / **{grade}年級** / **第{sem}學期**")
+        # num_rows="dynamic" 時 Streamlit 以資料內容決定元件身分，資料一變即重建；
+        # 故以 editor_key_counter 明確換 key 重置殘留的 edited_rows，回傳值不使用
         st.data_editor(
             st.session_state['data'], num_rows="dynamic", width='stretch', height=600,
             key=f"main_editor_{st.session_state['editor_key_counter']}", on_change=on_editor_change,
-            column_config={
-                "勾選": st.column_config.CheckboxColumn("勾選", width="small"),
-                "uuid": None, "科別": None, "年級": None, "學期": None,
-                "課程類別": st.column_config.TextColumn("類別", width="small", disabled=True),
-                "課程名稱": st.column_config.TextColumn("課程名稱", width="medium", disabled=True),
-                "適用班級": st.column_config.TextColumn("適用班級", width="medium", disabled=True),
-                "教科書(優先1)": st.column_config.TextColumn("教科書(1)", width="medium", disabled=True),
-                "冊次(1)": st.column_config.TextColumn("冊次(1)", width="small", disabled=True),
-                "出版社(1)": st.column_config.TextColumn("出版社(1)", width="small", disabled=True),
-                "備註1": st.column_config.TextColumn("備註", width="small", disabled=True),
-                "教科書(優先2)": st.column_config.TextColumn("教科書(2)", width="medium", disabled=True),
-                "冊次(2)": st.column_config.TextColumn("冊次(2)", width="small", disabled=True),
-                "出版社(2)": st.column_config.TextColumn("出版社(2)", width="small", disabled=True),
-                "備註2": st.column_config.TextColumn("備註2", width="small", disabled=True),
-                "審定字號(1)": st.column_config.TextColumn("字號(1)", width="small", disabled=True),
-                "審定字號(2)": st.column_config.TextColumn("字號(2)", width="small", disabled=True),
-            },
-            column_order=["勾選", "課程類別", "課程名稱", "適用班級", "教科書(優先1)", "冊次(1)", "出版社(1)", "審定字號(1)", "備註1", "教科書(優先2)", "冊次(2)", "出版社(2)", "審定字號(2)", "備註2"]
+            column_config=_editor_column_config(),
+            column_order=EDITOR_COLUMN_ORDER
         )
     else: st.info("👈 請先在左側選擇科別")
 